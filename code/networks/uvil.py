@@ -1,3 +1,7 @@
+import contextlib
+import itertools
+import math
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -6,14 +10,6 @@ from vision_lstm.vision_lstm_util import interpolate_sincos
 from timm.layers import to_ntuple
 import einops
 
-import numpy as np
-from einops import rearrange
-from timm.layers import to_ntuple
-
-from torchinfo import summary
-from calflops import calculate_flops
-
-
 
 class PatchMerging(nn.Module):
     r""" Patch Merging Layer.
@@ -30,6 +26,10 @@ class PatchMerging(nn.Module):
         self.dim = dim
         self.ndim = len(input_resolution)
         self.num_patches_merged = 2 ** self.ndim  # e.g. 4 for 2D, 8 for 3D
+        H, W = input_resolution
+        assert H % 2 == 0 and W % 2 == 0, f"x size ({H}*{W}) are not even."
+        # tokens are already channels-last (B, L, C), so this Linear is the NHWC 1x1 conv GEMM;
+        # an nn.Conv2d would only add permutes around the (B, L, C) ViL blocks
         self.reduction = nn.Linear(4 * dim, 2 * dim, bias=False)
         self.norm = norm_layer(4 * dim)
 
@@ -39,16 +39,12 @@ class PatchMerging(nn.Module):
         """
         H, W = self.input_resolution
         B, L, C = x.shape
-        assert L == H * W, "input feature has wrong size"
-        assert H % 2 == 0 and W % 2 == 0, f"x size ({H}*{W}) are not even."
 
-        x = x.view(B, H, W, C)
-
-        x0 = x[:, 0::2, 0::2, :]  # B H/2 W/2 C
-        x1 = x[:, 1::2, 0::2, :]  # B H/2 W/2 C
-        x2 = x[:, 0::2, 1::2, :]  # B H/2 W/2 C
-        x3 = x[:, 1::2, 1::2, :]  # B H/2 W/2 C
-        x = torch.cat([x0, x1, x2, x3], -1)  # B H/2 W/2 4*C
+        # gather the 2x2 neighbourhood in a single copy; the (w-offset, h-offset) channel order matches
+        # the concat of x[:, 0::2, 0::2], x[:, 1::2, 0::2], x[:, 0::2, 1::2], x[:, 1::2, 1::2]
+        # (F.pixel_unshuffle orders channels as (c, h-offset, w-offset) and would need a second copy to match)
+        x = x.view(B, H // 2, 2, W // 2, 2, C)
+        x = x.permute(0, 1, 3, 4, 2, 5).contiguous()  # B H/2 W/2 2 2 C
         x = x.view(B, -1, 4 * C)  # B H/2*W/2 4*C
 
         x = self.norm(x)
@@ -62,6 +58,7 @@ class PatchExpand(nn.Module):
         super().__init__()
         self.input_resolution = input_resolution
         self.dim = dim
+        # like PatchMerging.reduction, a Linear on channels-last (B, L, C) tokens is already the 1x1 conv GEMM
         self.expand = nn.Linear(dim, 2 * dim, bias=False) if dim_scale == 2 else nn.Identity()
         self.norm = norm_layer(dim // dim_scale)
 
@@ -72,11 +69,12 @@ class PatchExpand(nn.Module):
         H, W = self.input_resolution
         x = self.expand(x)
         B, L, C = x.shape
-        assert L == H * W, "input feature has wrong size"
 
-        x = x.view(B, H, W, C)
-        x = rearrange(x, 'b h w (p1 p2 c)-> b (h p1) (w p2) c', p1=2, p2=2, c=C // 4)
-        x = x.view(B, -1, C // 4)
+        c = C // 4
+        # b h w (p1 p2 c) -> b (h p1) (w p2) c
+        # (F.pixel_shuffle expects (c p1 p2) channel order, so it would need an extra permute copy here)
+        x = x.view(B, H, W, 2, 2, c).permute(0, 1, 3, 2, 4, 5).contiguous()
+        x = x.view(B, -1, c)
         x = self.norm(x)
 
         return x
@@ -95,25 +93,51 @@ class FinalPatchExpand_X4(nn.Module):
     def forward(self, x):
         """
         x: B, H*W, C
+        returns: B, C, 4*H, 4*W (channels-last memory format)
         """
         H, W = self.input_resolution
         x = self.expand(x)
         B, L, C = x.shape
-        assert L == H * W, "input feature has wrong size"
 
-        x = x.view(B, H, W, C)
-        x = rearrange(x, 'b h w (p1 p2 c)-> b (h p1) (w p2) c', p1=self.dim_scale, p2=self.dim_scale,
-                      c=C // (self.dim_scale ** 2))
-        x = x.view(B, -1, self.output_dim)
-        x = self.norm(x)
+        p = self.dim_scale
+        # normalize each output pixel before the shuffle, the norm only acts on the last dim
+        x = self.norm(x.view(B, H, W, p, p, C // (p * p)))
+        # b h w p1 p2 c -> b c (h p1) (w p2), stored as b (h p1) (w p2) c
+        x = x.permute(0, 1, 3, 2, 4, 5).reshape(B, H * p, W * p, self.output_dim)
+        x = x.permute(0, 3, 1, 2)
 
         return x
 
 
+class ConcatLinear(nn.Linear):
+    r""" Linear layer applied to the concatenation of the decoder features and a skip connection.
+
+    Computes linear(cat([x, skip], -1)) as two half matmuls so the concatenation is never materialized.
+    Parameters are those of nn.Linear(2 * dim, dim), so checkpoints remain compatible.
+
+    Args:
+        dim (int): Number of channels of both x and skip.
+        bias (bool, optional): If True, adds a learnable bias. Default: True
+    """
+
+    def __init__(self, dim, bias=True):
+        super().__init__(in_features=2 * dim, out_features=dim, bias=bias)
+        self.dim = dim
+
+    def forward(self, x, skip):
+        """
+        x: B, H*W, C
+        skip: B, H*W, C
+        """
+        C = self.dim
+        return F.linear(x, self.weight[:, :C], self.bias) + F.linear(skip, self.weight[:, C:])
+
+
 class VitPatchEmbed(nn.Module):
     def __init__(self, dim, num_channels, resolution, patch_size, stride=None, init_weights="xavier_uniform"):
         super().__init__()
         self.resolution = resolution
+        self._resolution = tuple(resolution)
         self.init_weights = init_weights
         self.ndim = len(resolution)
         self.patch_size = to_ntuple(self.ndim)(patch_size)
@@ -124,24 +148,10 @@ class VitPatchEmbed(nn.Module):
         for i in range(self.ndim):
             assert resolution[i] % self.patch_size[i] == 0, \
                 f"resolution[{i}] % patch_size[{i}] != 0 (resolution={resolution} patch_size={patch_size})"
-        self.seqlens = [resolution[i] // self.patch_size[i] for i in range(self.ndim)]
-        if self.patch_size == self.stride:
-            # use primitive type as np.prod gives np.int which is not compatible with all serialization/logging
-            self.num_patches = int(np.prod(self.seqlens))
-        else:
-            if self.ndim == 1:
-                conv_func = F.conv1d
-            elif self.ndim == 2:
-                conv_func = F.conv2d
-            elif self.ndim == 3:
-                conv_func = F.conv3d
-            else:
-                raise NotImplementedError
-            self.num_patches = conv_func(
-                input=torch.zeros(1, 1, *resolution),
-                weight=torch.zeros(1, 1, *self.patch_size),
-                stride=self.stride,
-            ).numel()
+        # output size of a conv without padding: floor((R - K) / S) + 1 (equals R // K if stride == patch_size)
+        self.seqlens = [(resolution[i] - self.patch_size[i]) // self.stride[i] + 1 for i in range(self.ndim)]
+        # math.prod keeps the primitive int type (np.prod gives np.int which is not compatible with all serialization/logging)
+        self.num_patches = math.prod(self.seqlens)
 
         if self.ndim == 1:
             conv_ctor = nn.Conv1d
@@ -153,6 +163,11 @@ class VitPatchEmbed(nn.Module):
             raise NotImplementedError
 
         self.proj = conv_ctor(num_channels, dim, kernel_size=self.patch_size, stride=self.stride)
+        if self.ndim == 2:
+            # channels-last output is already laid out as b h w c, so the permute below is free
+            self.proj = self.proj.to(memory_format=torch.channels_last)
+        # b c ... -> b ... c
+        self._perm = (0, *range(2, self.ndim + 2), 1)
         self.reset_parameters()
 
     def reset_parameters(self):
@@ -160,17 +175,20 @@ class VitPatchEmbed(nn.Module):
             pass
         elif self.init_weights == "xavier_uniform":
             # initialize as nn.Linear
+            # the weight may be channels-last, so initialize a flat copy instead of a view
             w = self.proj.weight.data
-            nn.init.xavier_uniform_(w.view([w.shape[0], -1]))
+            w.copy_(nn.init.xavier_uniform_(torch.empty(w.shape[0], w[0].numel())).view_as(w))
             nn.init.zeros_(self.proj.bias)
         else:
             raise NotImplementedError
 
     def forward(self, x):
-        assert all(x.size(i + 2) % self.patch_size[i] == 0 for i in range(self.ndim)), \
-            f"x.shape={x.shape} incompatible with patch_size={self.patch_size}"
+        # the construction resolution is validated in __init__, only check other resolutions
+        if x.shape[2:] != self._resolution:
+            assert all(x.size(i + 2) % self.patch_size[i] == 0 for i in range(self.ndim)), \
+                f"x.shape={x.shape} incompatible with patch_size={self.patch_size}"
         x = self.proj(x)
-        x = einops.rearrange(x, "b c ... -> b ... c")
+        x = x.permute(*self._perm).contiguous()
         return x
 
 # from kappamodules.vit import VitPosEmbed2d
@@ -200,6 +218,15 @@ class VitPosEmbed2d(nn.Module):
         return x + embed
     
 
+def compile_vilblocks(vilblock):
+    """ Compile the ViL block pairs of one stage in-place (state_dict keys are unchanged).
+    The blocks of a stage share dim and seqlens, so they can reuse the same compiled graph.
+    CUDA graphs are left to UViL.capture_cuda_graph instead of being nested inside it.
+    """
+    for blk in vilblock:
+        blk.compile(dynamic=False, mode="max-autotune-no-cudagraphs")
+
+
 class MyViLBlockEnc(nn.Module):
     """ A basic Vision xLSTM layer for one stage in encoder.
     """
@@ -214,6 +241,7 @@ class MyViLBlockEnc(nn.Module):
                  num_blocks,
                  init_weights,
                  downsample=None,
+                 compile_blocks=False,
                  ):
         super().__init__()
         self.vilblock = nn.ModuleList([
@@ -229,6 +257,8 @@ class MyViLBlockEnc(nn.Module):
             ) for i in range(depth)
             ],
         )
+        if compile_blocks:
+            compile_vilblocks(self.vilblock)
 
         # patch merging layer
         if downsample is not None:
@@ -257,6 +287,7 @@ class MyViLBlockDec(nn.Module):
                  num_blocks,
                  init_weights,
                  upsample=None,
+                 compile_blocks=False,
                  ):
         super().__init__()
         self.vilblock = nn.ModuleList([
@@ -272,6 +303,8 @@ class MyViLBlockDec(nn.Module):
             ) for i in range(depth)
         ],
         )
+        if compile_blocks:
+            compile_vilblocks(self.vilblock)
 
         # patch merging layer
         if upsample is not None:
@@ -311,6 +344,9 @@ class UViL(nn.Module):
                  proj_bias=True,
                  norm_bias=True,
                  init_weights="original",
+                 compile_blocks=False,         # compile every ViL block pair with torch.compile
+                 use_amp=False,                # run the forward pass under torch.autocast
+                 amp_dtype=torch.bfloat16,     # autocast dtype (LayerNorm is kept in fp32 by autocast)
                  ):
         super().__init__()
         self.input_shape = input_shape
@@ -323,6 +359,7 @@ class UViL(nn.Module):
         self.norm_layer = norm_layer
         self.depths = depth
         self.num_stages = num_stages
+        self._n_skips = num_stages
         self.stride = stride
         self.output_shape = output_shape
         self.mode = mode
@@ -334,6 +371,9 @@ class UViL(nn.Module):
         self.proj_bias = proj_bias
         self.norm_bias = norm_bias
         self.init_weights = init_weights
+        self.compile_blocks = compile_blocks
+        self.use_amp = use_amp
+        self.amp_dtype = amp_dtype
 
         # initialize patch_embed
         self.patch_embed = VitPatchEmbed(
@@ -352,8 +392,10 @@ class UViL(nn.Module):
         else:
             dpr = [drop_path_rate] * self.num_stages
 
-        current_patch_resolution = self.patch_embed.seqlens
-        # print(current_patch_resolution)# e.g. [H_p, W_p] or [D_p, H_p, W_p]
+        # patch grid geometry is fixed after construction; cache it as python ints
+        self._H, self._W = self.patch_embed.seqlens
+        # patch resolution of each encoder stage
+        self._stage_res = [(self._H >> s, self._W >> s) for s in range(self.num_stages)]
 
         # build encoder and bottleneck layers
         self.enc_layers = nn.ModuleList()
@@ -362,15 +404,14 @@ class UViL(nn.Module):
                 embed_dim=int(self.embed_dim * 2 ** idx_stage),
                 drop_path=dpr[idx_stage],
                 conv_kind=conv_kind,
-                seqlens=(
-                    current_patch_resolution[0] // (2 ** idx_stage),
-                    current_patch_resolution[1] // (2 ** idx_stage)),
+                seqlens=self._stage_res[idx_stage],
                 depth=depth,
                 proj_bias=proj_bias,
                 norm_bias=norm_bias,
                 num_blocks=2 * depth,
                 init_weights=init_weights,
                 downsample = PatchMerging if (idx_stage < self.num_stages - 1) else None,
+                compile_blocks=compile_blocks,
             )
             self.enc_layers.append(layer)
 
@@ -378,11 +419,10 @@ class UViL(nn.Module):
         self.dec_layers = nn.ModuleList()
         self.concat_back_dim = nn.ModuleList()
         for idx_stage in range(self.num_stages):
-            linear_concat = nn.Linear(in_features=2 * int(embed_dim * 2 ** (self.num_stages - 1 - idx_stage)),
-                                      out_features=int(embed_dim * 2 ** (self.num_stages - 1 - idx_stage)),) if idx_stage > 0 else nn.Identity()
+            linear_concat = ConcatLinear(dim=int(embed_dim * 2 ** (self.num_stages - 1 - idx_stage))) \
+                if idx_stage > 0 else nn.Identity()
             if idx_stage == 0:
-                dec_layer = PatchExpand(input_resolution=(current_patch_resolution[0] // (2 ** (self.num_stages -1 - idx_stage)),
-                                                               current_patch_resolution[1] // (2 ** (self.num_stages - 1 - idx_stage))),
+                dec_layer = PatchExpand(input_resolution=self._stage_res[self.num_stages - 1 - idx_stage],
                                              dim=embed_dim * 2 ** (num_stages - 1 - idx_stage),
                                              dim_scale=2,
                                              norm_layer=norm_layer)
@@ -391,27 +431,36 @@ class UViL(nn.Module):
                     embed_dim=int(self.embed_dim * 2 ** (self.num_stages -1 - idx_stage)),
                     drop_path=dpr[idx_stage],
                     conv_kind=conv_kind,
-                    seqlens=(
-                        current_patch_resolution[0] // (2 ** (self.num_stages -1 - idx_stage)),
-                        current_patch_resolution[1] // (2 ** (self.num_stages -1 - idx_stage))),
+                    seqlens=self._stage_res[self.num_stages - 1 - idx_stage],
                     depth=depth,
                     proj_bias=proj_bias,
                     norm_bias=norm_bias,
                     num_blocks=2 * depth,
                     init_weights=init_weights,
                     upsample=PatchExpand if (idx_stage < self.num_stages - 1) else None,
+                    compile_blocks=compile_blocks,
                 )
 
             self.dec_layers.append(dec_layer)
             self.concat_back_dim.append(linear_concat)
 
+        # unused in forward (its output was always discarded); kept so existing checkpoints load with strict=True
         self.norm_upsample = norm_layer(self.embed_dim)
-        self.final_patch_expnad = FinalPatchExpand_X4(input_resolution=(self.img_size // self.patch_size,
-                                                                self.img_size // self.patch_size),
+        self.final_patch_expnad = FinalPatchExpand_X4(input_resolution=(self._H, self._W),
                                               dim_scale=4, dim=embed_dim,)
         # print(f"img_size: {self.img_size}, patch_size: {self.patch_size}, dim: {embed_dim}")
         self.final_conv = nn.Conv2d(in_channels=embed_dim, out_channels=self.num_classes, kernel_size=1, bias=False)
 
+        # channels-last conv matches the (B, H, W, C) token layout, so the permute before it is free
+        self.final_conv = self.final_conv.to(memory_format=torch.channels_last)
+
+        # static input/output of a captured CUDA graph (see capture_cuda_graph)
+        self._cuda_graph = None
+        self._graph_input = None
+        self._graph_output = None
+        self._graph_amp = None
+        self._graph_ptrs = None
+
 
     def forward_encoder(self, x):
         # embed patches
@@ -420,11 +469,11 @@ class UViL(nn.Module):
         x = self.pos_embed(x)
         # flatten to 1d
         x = einops.rearrange(x, "b ... d -> b (...) d")
-        x_downsample = []
+        x_downsample = [None] * self._n_skips
 
         # ViL blocks
         for idx, block in enumerate(self.enc_layers):
-            x_downsample.append(x)
+            x_downsample[idx] = x
             x = block(x)
             # print(f"x shape for {idx} is {x.shape}")
         # x = self.norm(x)
@@ -439,35 +488,97 @@ class UViL(nn.Module):
                 # print(f"x encoder shape: {x.shape}")
                 # print(f"x_downsample shape for {len(x_downsample)-1-idx}: {x_downsample[len(x_downsample)-1-idx].shape}")
                 # print(f"len(x_downsample): {len(x_downsample)}")
-                x = torch.cat((x, x_downsample[len(x_downsample)-1-idx]), dim=-1)
-                x = self.concat_back_dim[idx](x)
+                x = self.concat_back_dim[idx](x, x_downsample[self._n_skips - 1 - idx])
                 x = dec_layer(x)
-        self.norm_upsample(x)
         return x
 
     def final_4x_upsample(self, x):
-        H, W = self.patch_embed.seqlens
-        # print(f"H: {H}, W: {W}")
-        B, L, C = x.shape
-        assert L == H * W, "input features has wrong size"
-
         # print(f"x before patch expand in final: {x.shape}")
-        x = self.final_patch_expnad(x)
-        # print(f"x after patch expand in final: {x.shape}")
-        x = x.view(B, 4 * H, 4 * W, -1)
-        # print(f"x after view: {x.shape}")
-        x = x.permute(0, 3, 1, 2)  # B,C,H,W
+        x = self.final_patch_expnad(x)  # B,C,H,W (channels-last)
         # print(x.shape)
         x = self.final_conv(x)
         return x
 
     def forward(self, x):   # x: (B, C, H, W)
-        x, x_downsample = self.forward_encoder(x)
-        x = self.foraward_decoder(x, x_downsample)
-        x = self.final_4x_upsample(x)
+        dtype = x.dtype
+        x = x.contiguous(memory_format=torch.channels_last)
+        # without use_amp, leave any autocast context of the caller untouched
+        if self.use_amp:
+            amp_ctx = torch.autocast(device_type=x.device.type, dtype=self.amp_dtype)
+        else:
+            amp_ctx = contextlib.nullcontext()
+        with amp_ctx:
+            x, x_downsample = self.forward_encoder(x)
+            x = self.foraward_decoder(x, x_downsample)
+            x = self.final_4x_upsample(x)
+        if self.use_amp:
+            # return logits in the input dtype
+            x = x.to(dtype)
         return x
 
+    @torch.no_grad()
+    def capture_cuda_graph(self, example_input, num_warmup=3):
+        """ Record the forward pass as a CUDA graph for fixed-shape inference (replayed by forward_graph).
+        The graph is dropped when parameters are moved/cast (.to, .cuda, .half, ...) and ignored when
+        use_amp/amp_dtype change or parameter/buffer tensors are replaced (e.g. load_state_dict(assign=True));
+        call capture_cuda_graph again afterwards.
+        """
+        assert not self.training, "CUDA graph capture is only supported in eval mode"
+        assert example_input.is_cuda, "CUDA graph capture requires a CUDA input"
+        static_input = example_input.clone()
+
+        # warmup on a side stream so lazy initializations are not recorded
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            for _ in range(num_warmup):
+                self(static_input)
+        torch.cuda.current_stream().wait_stream(stream)
+
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph):
+            static_output = self(static_input)
+
+        self._cuda_graph = graph
+        self._graph_input = static_input
+        self._graph_output = static_output
+        self._graph_amp = (self.use_amp, self.amp_dtype)
+        self._graph_ptrs = self._state_data_ptrs()
+
+    def _state_data_ptrs(self):
+        # storage addresses the captured graph reads parameters/buffers from
+        return [t.data_ptr() for t in itertools.chain(self.parameters(), self.buffers())]
+
+    def release_cuda_graph(self):
+        self._cuda_graph = None
+        self._graph_input = None
+        self._graph_output = None
+        self._graph_amp = None
+        self._graph_ptrs = None
+
+    def _apply(self, fn, *args, **kwargs):
+        # moving/casting reallocates the parameters the captured graph reads from
+        self.release_cuda_graph()
+        return super()._apply(fn, *args, **kwargs)
+
+    def forward_graph(self, x):
+        # fall back to eager execution whenever the captured graph does not apply
+        if (self.training
+                or self._cuda_graph is None
+                or self._graph_amp != (self.use_amp, self.amp_dtype)
+                or x.shape != self._graph_input.shape
+                or x.dtype != self._graph_input.dtype
+                or x.device != self._graph_input.device
+                or self._graph_ptrs != self._state_data_ptrs()):
+            return self(x)
+        self._graph_input.copy_(x)
+        self._cuda_graph.replay()
+        return self._graph_output.clone()
+
 if __name__ == "__main__":
+    from torchinfo import summary
+    from calflops import calculate_flops
+
     model = UViL(input_shape=(1, 224, 224),
                  num_classes=4,
                  patch_size=4,